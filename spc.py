@@ -4,27 +4,60 @@
 
 import geopandas
 import requests
-from os import path, listdir, remove
+from os import path, listdir, remove, cpu_count
 from pathlib import Path
 import zipfile
-from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from cartopy import crs as ccrs
 from cartopy import feature as cfeat
 from matplotlib import pyplot as plt
 from matplotlib.patches import Patch
+from matplotlib.collections import PathCollection
+from cartopy.mpl.path import shapely_to_path
+import shapely
+from shapely.geometry import MultiPolygon
+from pyproj import Transformer
+import numpy as np
 from datetime import datetime as dt
-import pandas as pd
-from shutil import rmtree
+import re
+from shutil import rmtree, copyfileobj
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+import traceback
+import sys
 
 basePath = path.realpath(path.dirname(__file__))
 axExtent = [-130, -60, 20, 50]
+statesFeature = cfeat.STATES.with_scale("50m")
+coastlineFeature = cfeat.COASTLINE.with_scale("50m")
+outlookProjection = ccrs.LambertConformal()
+toOutlookProjection = Transformer.from_crs("EPSG:4326", outlookProjection, always_xy=True)
 
 hasHelpers = False
 if path.exists(path.join(basePath, "HDWX_helpers.py")):
     hasHelpers = True
     import HDWX_helpers
 
-def plotOutlook(data, dayNum, startTime, finalTime, issueTime, outlookType):
+def resetOutlookAxes(fig):
+    fig.clear()
+    px = 1/plt.rcParams["figure.dpi"]
+    fig.set_size_inches(1920*px, 1080*px)
+    ax = fig.add_subplot(projection=outlookProjection)
+    ax.set_extent(axExtent, crs=ccrs.PlateCarree())
+    return ax
+
+
+def projectPolygons(geometries):
+    # Push every vertex in the group through one vectorized pyproj call and merge the result into a single compound path
+    geometries = geometries[~(geometries.isna() | geometries.is_empty)]
+    if len(geometries) == 0:
+        return None
+    polygons = geometries.explode(index_parts=False).values
+    projectedPolygons = shapely.transform(polygons, lambda coords: np.column_stack(toOutlookProjection.transform(coords[:, 0], coords[:, 1])))
+    return shapely_to_path(MultiPolygon(list(projectedPolygons)))
+
+
+def plotOutlook(fig, ax, data, dayNum, startTime, finalTime, issueTime, outlookType):
     legend_elements = []
     if outlookType == "cat":
         legend_elements.append(Patch(facecolor="#00000000", edgecolor="#00000000", label="Classification Info:\nhttps://www.spc.noaa.gov/misc/SPC_probotlk_info.html"))
@@ -49,29 +82,34 @@ def plotOutlook(data, dayNum, startTime, finalTime, issueTime, outlookType):
         legend_elements.append(Patch(facecolor="#00000000", edgecolor="#00000000", label="Classification Info:\nhttps://www.spc.noaa.gov/misc/about.html#FireWx"))
         prettyOutlookType = "Fire Weather"
         sigRisk = ""
-    fig = plt.figure()
-    px = 1/plt.rcParams["figure.dpi"]
-    fig.set_size_inches(1920*px, 1080*px)
-    ax = plt.axes(projection=ccrs.LambertConformal())
-    ax.set_extent(axExtent, crs=ccrs.PlateCarree())
-    for dnval in data["DN"].unique():
-        polysForCat = data[data["DN"] == dnval]
-        if len(polysForCat) == 0:
-            continue
+    shortLabels = data["LABEL2"].astype(str).str.replace(r"General |s Risk| (?:Hail|Tornado|Wind|Fire|Risk)", "", regex=True)
+    # Collect every category into one collection (plus one for hatched significant areas) so each is a single draw call
+    fillPaths, fillFaceColors, fillEdgeColors = [], [], []
+    sigPaths, sigEdgeColors = [], []
+    for dnval, polysForCat in data.groupby("DN", sort=False):
         if dnval == 0:
             continue
         fcolor = str(polysForCat["fill"].iloc[0])
         ecolor = str(polysForCat["stroke"].iloc[0])
-        label = str(polysForCat["LABEL2"].iloc[0]).replace("General ", "").replace("s Risk", "").replace(" Hail", "").replace(" Tornado", "").replace(" Wind", "").replace(" Fire", "").replace(" Risk", "")
+        label = shortLabels.loc[polysForCat.index[0]]
+        groupPath = projectPolygons(polysForCat["geometry"])
         if "Significant" in label:
-            ax.add_geometries(polysForCat["geometry"], crs=ccrs.PlateCarree(), facecolor="#00000000", edgecolor=ecolor, linewidth=1, hatch="///")
+            if groupPath is not None:
+                sigPaths.append(groupPath)
+                sigEdgeColors.append(ecolor)
             legend_elements.append(Patch(facecolor="#00000000", edgecolor=ecolor, hatch="///", label=f"{label} {sigRisk}"))
         else:
-            ax.add_geometries(polysForCat["geometry"], crs=ccrs.PlateCarree(), facecolor=fcolor, edgecolor=ecolor, linewidth=0.75)
-
+            if groupPath is not None:
+                fillPaths.append(groupPath)
+                fillFaceColors.append(fcolor)
+                fillEdgeColors.append(ecolor)
             legend_elements.append(Patch(facecolor=fcolor, edgecolor=ecolor, label=label))
-    ax.add_feature(cfeat.STATES.with_scale("50m"), linewidth=0.5)
-    ax.add_feature(cfeat.COASTLINE.with_scale("50m"), linewidth=0.5)
+    if len(fillPaths) > 0:
+        ax.add_collection(PathCollection(fillPaths, facecolors=fillFaceColors, edgecolors=fillEdgeColors, linewidths=0.75, transform=ax.transData), autolim=False)
+    if len(sigPaths) > 0:
+        ax.add_collection(PathCollection(sigPaths, facecolors="#00000000", edgecolors=sigEdgeColors, linewidths=1, hatch="///", transform=ax.transData), autolim=False)
+    ax.add_feature(statesFeature, linewidth=0.5)
+    ax.add_feature(coastlineFeature, linewidth=0.5)
     if len(legend_elements) == 1:
         ax.text(0.5, 0.5, "No areas", transform=ax.transAxes, ha="center", va="center")
     else:
@@ -95,65 +133,96 @@ def plotOutlook(data, dayNum, startTime, finalTime, issueTime, outlookType):
         savePaths["1213"] = path.join(basePath, "output", "products", "noaa", "spc", "tornout")
     elif outlookType == "fire":
         savePaths["1215"] = path.join(basePath, "output", "products", "noaa", "spc", "fireout")
+    # Metadata is handed back to the caller rather than written here, several outlooks share a product ID and may be plotted in parallel
+    metadataToWrite = []
+    issueTimeDirs = issueTime.strftime("%Y %m %d %H00").split()
     for productID in savePaths.keys():
         savePath = savePaths[productID]
         productID = int(productID)
-        savePath = path.join(savePath, issueTime.strftime("%Y"), issueTime.strftime("%m"), issueTime.strftime("%d"), issueTime.strftime("%H00"))
+        savePath = path.join(savePath, *issueTimeDirs)
         Path(savePath).mkdir(parents=True, exist_ok=True)
         if hasHelpers:
-            HDWX_helpers.writeJson(basePath, productID, issueTime.replace(minute=0).replace(second=0), f"day{dayNum}.png", finalTime, ["0,0", "0,0"], 3600)
             HDWX_helpers.saveImage(fig, path.join(savePath, f"day{dayNum}.png"))
+            metadataToWrite.append((basePath, productID, issueTime.replace(minute=0).replace(second=0), f"day{dayNum}.png", finalTime, ["0,0", "0,0"], 3600))
         else:
             fig.savefig(path.join(savePath, f"day{dayNum}.png"))
-    plt.close(fig)
+    return metadataToWrite
+
+
+# Set by initPlotWorker in each pool process. It's never closed explicitly, it lives exactly as long as the worker and goes away when the pool shuts down.
+workerFig = None
+
+def initPlotWorker():
+    # Each plotting process reuses its own figure across every outlook it draws
+    global workerFig
+    workerFig = plt.figure()
+
+
+def plotOutlookTask(task):
+    data, dayNum, startTime, finalTime, issueTime, outlookType = task
+    try:
+        ax = resetOutlookAxes(workerFig)
+        return plotOutlook(workerFig, ax, data, dayNum, startTime, finalTime, issueTime, outlookType)
+    except Exception:
+        # Don't let one bad outlook take down the metadata for the rest of the run
+        print(f"Failed to plot day {dayNum} {outlookType} outlook:\n{traceback.format_exc()}")
+        return None
+
+
+def fetchOutlook(dayNum, outlookKind):
+    dayInputPath = path.join(basePath, "input", f"day{dayNum}-{outlookKind}")
+    Path(dayInputPath).mkdir(parents=True, exist_ok=True)
+    if outlookKind == "conv":
+        if dayNum < 4:
+            zipURL = f"https://www.spc.noaa.gov/products/outlook/day{dayNum}otlk-shp.zip"
+        else:
+            zipURL = f"https://www.spc.noaa.gov/products/exper/day4-8/day{dayNum}prob-shp.zip"
+    else:
+        if dayNum < 3:
+            zipURL = f"https://www.spc.noaa.gov/products/fire_wx/day{dayNum}firewx-shp.zip"
+        else:
+            zipURL = f"https://www.spc.noaa.gov/products/exper/fire_wx/day{dayNum}firewx-shp.zip"
+    with requests.get(zipURL, stream=True) as response, SpooledTemporaryFile(max_size=16<<20) as zipBuffer:
+        response.raw.decode_content = True
+        copyfileobj(response.raw, zipBuffer)
+        zipBuffer.seek(0)
+        with zipfile.ZipFile(zipBuffer) as z:
+            z.extractall(dayInputPath)
+    return dayNum, outlookKind, dayInputPath
 
 
+def saveLastModified(lastModifiedPath, lastModified):
+    if lastModified is not None:
+        with open(lastModifiedPath, "w") as lastModifiedHandle:
+            lastModifiedHandle.write(lastModified)
 
 
 if __name__ == "__main__":
-    lastUpdateCheckPage = pd.read_html("https://www.spc.noaa.gov/products/outlook/")[5]
-    issueTime = dt.strptime(lastUpdateCheckPage[1].iloc[1].split("document.write")[0].replace(f" {str(int(dt.utcnow().strftime('%d')))} ", f" {dt.utcnow().strftime('%d')} "), f"Updated: %a %b %d %H:%M:%S UTC %Y")
+    # Bail out with a cheap HEAD request if the outlook page is the same one a previous run already handled
+    lastModified = requests.head("https://www.spc.noaa.gov/products/outlook/").headers.get("Last-Modified")
+    lastModifiedPath = path.join(basePath, "spcLastModified.txt")
+    if lastModified is not None and path.exists(lastModifiedPath):
+        with open(lastModifiedPath, "r") as lastModifiedHandle:
+            if lastModifiedHandle.read() == lastModified:
+                exit()
+    lastUpdateCheckPage = requests.get("https://www.spc.noaa.gov/products/outlook/").text
+    issueTimeMatch = re.search(r"Updated:\s+([A-Z][a-z]{2} [A-Z][a-z]{2}\s+\d+\s+\d{2}:\d{2}:\d{2} UTC \d{4})", lastUpdateCheckPage)
+    if issueTimeMatch is None:
+        raise ValueError("Couldn't find the \"Updated:\" timestamp on the SPC outlook page")
+    issueTime = dt.strptime(" ".join(issueTimeMatch.group(1).split()), "%a %b %d %H:%M:%S UTC %Y")
     if path.exists(path.join(basePath, "output", "metadata", "products", "1213", issueTime.strftime("%Y%m%d%H00.json"))):
+        # This page has already been handled, remember it so later runs can stop at the HEAD request
+        saveLastModified(lastModifiedPath, lastModified)
         exit()
     inputPath = path.join(basePath, "input")
     Path(inputPath).mkdir(parents=True, exist_ok=True)
-    for dayNum in range(1, 9):
-        convDayInputPath = path.join(inputPath, f"day{dayNum}-conv")
-        Path(convDayInputPath).mkdir(parents=True, exist_ok=True)
-        if dayNum < 4:
-            file = requests.get(f"https://www.spc.noaa.gov/products/outlook/day{dayNum}otlk-shp.zip")
-        else:
-            file = requests.get(f"https://www.spc.noaa.gov/products/exper/day4-8/day{dayNum}prob-shp.zip")
-        z = zipfile.ZipFile(BytesIO(file.content))
-        z.extractall(convDayInputPath)
-        filesInTarget = listdir(convDayInputPath)
-        infoFile = None
-        shapeFiles = []
-        for file in filesInTarget:
-            if file.endswith(".info"):
-                infoFile = file
-            elif file.endswith(".shp"):
-                shapeFiles.append(file)
-        with open(path.join(convDayInputPath, infoFile), "r") as infoFileHandle:
-            infoLines = infoFileHandle.readlines()
-        startTime = dt.strptime(infoLines[0], "Product Valid Time Begin: %Y-%m-%d %H:%M:%S+00:00\n")
-        endTime =  dt.strptime(infoLines[1], "Product Valid Time End: %Y-%m-%d %H:%M:%S+00:00\n")
-        for shapeFile in shapeFiles:
-            outlookType = shapeFile.split("_")[-1].lower().replace(".shp", "")
-            if "sig" in outlookType:
-                continue
-            gpdata = geopandas.read_file(path.join(convDayInputPath, shapeFile))
-            plotOutlook(gpdata, dayNum, startTime, endTime, issueTime, outlookType)
-    for dayNum in range(1, 9):
-        convDayInputPath = path.join(inputPath, f"day{dayNum}-fire")
-        Path(convDayInputPath).mkdir(parents=True, exist_ok=True)
-        if dayNum < 3:
-            file = requests.get(f"https://www.spc.noaa.gov/products/fire_wx/day{dayNum}firewx-shp.zip")
-        else:
-            file = requests.get(f"https://www.spc.noaa.gov/products/exper/fire_wx/day{dayNum}firewx-shp.zip")
-        z = zipfile.ZipFile(BytesIO(file.content))
-        z.extractall(convDayInputPath)
-        filesInTarget = listdir(convDayInputPath)
+    # Downloads are independent and latency-bound, so fetch them all at once. Plotting happens in separate processes below since matplotlib isn't thread-safe.
+    fetchTasks = [(dayNum, outlookKind) for outlookKind in ["conv", "fire"] for dayNum in range(1, 9)]
+    with ThreadPoolExecutor(8) as executor:
+        fetchResults = list(executor.map(lambda task: fetchOutlook(*task), fetchTasks))
+    plotTasks = []
+    for dayNum, outlookKind, dayInputPath in fetchResults:
+        filesInTarget = listdir(dayInputPath)
         infoFile = None
         shapeFiles = []
         for file in filesInTarget:
@@ -161,14 +230,34 @@ if __name__ == "__main__":
                 infoFile = file
             elif file.endswith(".shp"):
                 shapeFiles.append(file)
-        with open(path.join(convDayInputPath, infoFile), "r") as infoFileHandle:
+        with open(path.join(dayInputPath, infoFile), "r") as infoFileHandle:
             infoLines = infoFileHandle.readlines()
         startTime = dt.strptime(infoLines[0], "Product Valid Time Begin: %Y-%m-%d %H:%M:%S+00:00\n")
         endTime =  dt.strptime(infoLines[1], "Product Valid Time End: %Y-%m-%d %H:%M:%S+00:00\n")
         for shapeFile in shapeFiles:
-            if "dryltg" in shapeFile:
+            if outlookKind == "conv":
+                outlookType = shapeFile.split("_")[-1].lower().replace(".shp", "")
+                if "sig" in outlookType:
+                    continue
+            else:
+                if "dryltg" in shapeFile:
+                    continue
+                outlookType = "fire"
+            gpdata = geopandas.read_file(path.join(dayInputPath, shapeFile), engine="pyogrio")
+            plotTasks.append((gpdata, dayNum, startTime, endTime, issueTime, outlookType))
+    # Each outlook writes its own image, so render them across processes
+    allPlotted = True
+    with mp.Pool(cpu_count(), initializer=initPlotWorker) as pool:
+        # Metadata is written here as results come in, in task order so frames sharing a product ID stay in day order
+        for metadataToWrite in pool.imap(plotOutlookTask, plotTasks):
+            if metadataToWrite is None:
+                allPlotted = False
                 continue
-            gpdata = geopandas.read_file(path.join(convDayInputPath, shapeFile))
-            plotOutlook(gpdata, dayNum, startTime, endTime, issueTime, "fire")
+            if hasHelpers:
+                for jsonArgs in metadataToWrite:
+                    HDWX_helpers.writeJson(*jsonArgs)
     rmtree(path.join(basePath, "input"))
-    
\ No newline at end of file
+    saveLastModified(lastModifiedPath, lastModified)
+    if not allPlotted:
+        # Other outlooks' metadata has already been written, but still fail the run so the broken plot shows up in the service status
+        sys.exit(1)
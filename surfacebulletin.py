@@ -26,9 +26,17 @@ import xarray as xr
 import numpy as np
 from scipy import ndimage
 import sys
+import shapely
 
 
 basePath = path.realpath(path.dirname(__file__))
+statesFeature = cfeat.STATES.with_scale("50m")
+coastlineFeature = cfeat.COASTLINE.with_scale("50m")
+lambertConformal = ccrs.LambertConformal()
+plateCarree = ccrs.PlateCarree()
+_airports = pd.read_csv(get_test_data("airport-codes.csv"), usecols=["ident", "type"])
+airportIdents = frozenset(_airports.loc[_airports["type"].isin(("large_airport", "medium_airport", "small_airport")), "ident"])
+del _airports
 hasHelpers = False
 if path.exists(path.join(basePath, "HDWX_helpers.py")):
     import HDWX_helpers
@@ -51,12 +59,14 @@ def addRTMAPressure(ax, validTime):
     rtmaLink = f"https://nomads.ncep.noaa.gov/cgi-bin/filter_rtma2p5.pl?dir=%2Frtma2p5.{validTime.strftime('%Y%m%d')}&file=rtma2p5.t{validTime.strftime('%H')}z.2dvaranl_ndfd.grb2_wexp&var_HGT=on&var_PRES=on&var_TMP=on&lev_2_m_above_ground=on&lev_surface=on"
     urllib.request.urlretrieve(rtmaLink, "rtma.grib2")
     rtmaData = xr.open_dataset("rtma.grib2", engine="cfgrib", backend_kwargs={"indexpath" : ""})
-    orogData = rtmaData.orog.metpy.quantify()
-    barometricPressData = rtmaData.sp.metpy.quantify()
-    tempData = rtmaData.t2m.metpy.quantify()
-    mslpData = barometricPressData * np.exp(orogData*constants.earth_gravity/(constants.dry_air_gas_constant*tempData))
-    mslpData = mslpData.metpy.convert_units("hPa")
-    mslpData.data = ndimage.gaussian_filter(mslpData.data, 20)
+    # Reduce surface pressure to sea level on the raw arrays, RTMA ships these in m, Pa, and K
+    gOverR = (constants.earth_gravity / constants.dry_air_gas_constant).to("K/m").m
+    mslpValues = rtmaData.sp.values * np.exp(rtmaData.orog.values * gOverR / rtmaData.t2m.values) * 0.01
+    mslpData = xr.DataArray(mslpValues, coords=rtmaData.sp.coords, dims=rtmaData.sp.dims, attrs={"units" : "hPa"})
+    # Approximate the sigma 20 smoothing on a 4x coarser grid (sigma 5) and interpolate back for ~1/16th of the work.
+    # Block-average before decimating so the noisy terrain-reduced field doesn't alias onto the coarse grid.
+    mslpCoarse = ndimage.gaussian_filter(ndimage.uniform_filter(mslpData.data, 4)[::4, ::4], 5)
+    mslpData.data = ndimage.zoom(mslpCoarse, np.array(mslpData.shape) / np.array(mslpCoarse.shape), order=1)
     levelsToContour = np.arange((np.nanmin(mslpData.data) // 4) * 4, np.nanmax(mslpData.data)+4, 4)
     contourmap = ax.contour(mslpData.longitude, mslpData.latitude, mslpData, colors="maroon", levels=levelsToContour, transform=ccrs.PlateCarree(), transform_first=True, linewidths=0.5)
     contourLabels = ax.clabel(contourmap, levels=levelsToContour, fontsize=8, inline_spacing=-9)
@@ -67,12 +77,12 @@ def addRTMAPressure(ax, validTime):
 def addStationPlot(ax, validTime):
     metarTime = validTime.replace(minute=0, second=0, microsecond=0)
     stationCatalog = TDSCatalog("https://thredds.ucar.edu/thredds/catalog/noaaport/text/metar/catalog.xml")
-    airports = pd.read_csv(get_test_data("airport-codes.csv"))
-    airports = airports[(airports["type"] == "large_airport") | (airports["type"] == "medium_airport") | (airports["type"] == "small_airport")]
     try:
         dataset = stationCatalog.datasets.filter_time_nearest(metarTime)
         dataset.download()
-        [remove(file) for file in sorted(listdir()) if "metar_" in file and file != dataset.name]
+        for file in listdir():
+            if file.startswith("metar_") and file != dataset.name:
+                remove(file)
     except Exception as e:
         print(stationCatalog.datasets.filter_time_nearest(metarTime).remote_open().read())
     if path.exists(dataset.name):
@@ -81,20 +91,25 @@ def addStationPlot(ax, validTime):
         return
     metarUnits = metarData.units
 
-    metarDataFilt = metarData[metarData["station_id"].isin(airports["ident"])]
+    metarDataFilt = metarData[metarData["station_id"].isin(airportIdents)]
     metarDataFilt = metarDataFilt.dropna(how="any", subset=["longitude", "latitude", "station_id", "wind_speed", "wind_direction", "air_temperature", "dew_point_temperature", "air_pressure_at_sea_level", "current_wx1_symbol", "cloud_coverage"])
     metarDataFilt = metarDataFilt.drop_duplicates(subset=["station_id"], keep="last")
     metarData = pandas_dataframe_to_unit_arrays(metarDataFilt, metarUnits)
     metarData["u"], metarData["v"] = mpcalc.wind_components(metarData["wind_speed"], metarData["wind_direction"])
-    locationsInMeters = ccrs.LambertConformal().transform_points(ccrs.PlateCarree(), metarData["longitude"].m, metarData["latitude"].m)
+    locationsInMeters = lambertConformal.transform_points(plateCarree, np.ascontiguousarray(metarData["longitude"].m, dtype=np.float64), np.ascontiguousarray(metarData["latitude"].m, dtype=np.float64))
     overlap_prevent = mpcalc.reduce_point_density(locationsInMeters[:, 0:2], 200000)
-    stations = mpplots.StationPlot(ax, metarData["longitude"][overlap_prevent], metarData["latitude"][overlap_prevent], clip_on=True, transform=ccrs.PlateCarree(), fontsize=6)
-    stations.plot_parameter("NW", metarData["air_temperature"][overlap_prevent].to(units.degF), path_effects=[withStroke(linewidth=1, foreground="white")])
-    stations.plot_parameter("SW", metarData["dew_point_temperature"][overlap_prevent].to(units.degF), path_effects=[withStroke(linewidth=1, foreground="white")])
-    stations.plot_parameter("NE", metarData["air_pressure_at_sea_level"][overlap_prevent].to(units.hPa), formatter=lambda v: format(10 * v, '.0f')[-3:], path_effects=[withStroke(linewidth=1, foreground="white")])
-    stations.plot_symbol((-1.5, 0), metarData['current_wx1_symbol'][overlap_prevent], mpplots.current_weather, path_effects=[withStroke(linewidth=1, foreground="white")], fontsize=9)
-    stations.plot_symbol("C", metarData["cloud_coverage"][overlap_prevent], mpplots.sky_cover)
-    stations.plot_barb(metarData["u"][overlap_prevent], metarData["v"][overlap_prevent], sizes={"emptybarb" : 0})
+    # Index and unit-convert each field once, then hand plain arrays to the station plot
+    idx = np.where(overlap_prevent)[0]
+    tempF = metarData["air_temperature"][idx].to(units.degF).m
+    dewF = metarData["dew_point_temperature"][idx].to(units.degF).m
+    mslpHPa = metarData["air_pressure_at_sea_level"][idx].to(units.hPa).m
+    stations = mpplots.StationPlot(ax, metarData["longitude"][idx].m, metarData["latitude"][idx].m, clip_on=True, transform=plateCarree, fontsize=6)
+    stations.plot_parameter("NW", tempF, path_effects=[withStroke(linewidth=1, foreground="white")])
+    stations.plot_parameter("SW", dewF, path_effects=[withStroke(linewidth=1, foreground="white")])
+    stations.plot_parameter("NE", mslpHPa, formatter=lambda v: format(10 * v, '.0f')[-3:], path_effects=[withStroke(linewidth=1, foreground="white")])
+    stations.plot_symbol((-1.5, 0), metarData['current_wx1_symbol'][idx], mpplots.current_weather, path_effects=[withStroke(linewidth=1, foreground="white")], fontsize=9)
+    stations.plot_symbol("C", metarData["cloud_coverage"][idx], mpplots.sky_cover)
+    stations.plot_barb(metarData["u"][idx], metarData["v"][idx], sizes={"emptybarb" : 0})
     remove(dataset.name)
     return ax
 
@@ -116,7 +131,8 @@ def plot_bulletin(ax, data):
     # Handle H/L points using MetPy's StationPlot class
     for field in ("HIGH", "LOW"):
         rows = data[data.feature == field]
-        x, y = zip(*((pt.x, pt.y) for pt in rows.geometry))
+        coords = shapely.get_coordinates(rows.geometry.values)
+        x, y = coords[:, 0], coords[:, 1]
         sp = StationPlot(ax, x, y, transform=ccrs.PlateCarree(), clip_on=True)
         sp.plot_text("C", [field[0]] * len(x), **complete_style[field])
         sp.plot_parameter("S", rows.strength, **complete_style[field])
@@ -135,8 +151,10 @@ if __name__ == "__main__":
         df = BytesIO(response.read())
     df = parse_wpc_surface_bulletin(df)
     validTime = df.valid[0]
-    gisSaveDir = path.join(basePath, "output", "gisproducts", "noaa", "wpcsfcbull", validTime.strftime("%Y"), validTime.strftime("%m"), validTime.strftime("%d"), validTime.strftime("%H00"))
-    staticSaveDir = path.join(basePath, "output", "products", "noaa", "wpcsfcbull", validTime.strftime("%Y"), validTime.strftime("%m"), validTime.strftime("%d"), validTime.strftime("%H00"))
+    validTimeDirs = validTime.strftime("%Y %m %d %H00").split()
+    imageName = validTime.strftime("%H%M.png")
+    gisSaveDir = path.join(basePath, "output", "gisproducts", "noaa", "wpcsfcbull", *validTimeDirs)
+    staticSaveDir = path.join(basePath, "output", "products", "noaa", "wpcsfcbull", *validTimeDirs)
     if path.exists(gisSaveDir):
         filesInTargets = listdir(gisSaveDir)
         if len(filesInTargets) > 0:
@@ -153,14 +171,13 @@ if __name__ == "__main__":
         plot_bulletin(gisAx, df)
         px = 1/plt.rcParams["figure.dpi"]
         set_size(1920*px, 1080*px, ax=gisAx)
-        extent = gisAx.get_tightbbox(gisFig.canvas.get_renderer()).transformed(gisFig.dpi_scale_trans.inverted())
         Path(gisSaveDir).mkdir(parents=True, exist_ok=True)
         if hasHelpers:
             gisAxExtent = gisAx.get_extent(crs=ccrs.PlateCarree())
-            HDWX_helpers.writeJson(basePath, 1200, validTime.replace(minute=0), validTime.strftime("%H%M.png"), validTime, [f"{gisAxExtent[2]},{gisAxExtent[0]}", f"{gisAxExtent[3]},{gisAxExtent[1]}"], 300)
-            HDWX_helpers.saveImage(gisFig, path.join(gisSaveDir, validTime.strftime("%H%M.png")), transparent=True, bbox_inches=extent)
+            HDWX_helpers.writeJson(basePath, 1200, validTime.replace(minute=0), imageName, validTime, [f"{gisAxExtent[2]},{gisAxExtent[0]}", f"{gisAxExtent[3]},{gisAxExtent[1]}"], 300)
+            HDWX_helpers.saveImage(gisFig, path.join(gisSaveDir, imageName), transparent=True, bbox_inches="tight", pad_inches=0)
         else:
-            gisFig.savefig(path.join(gisSaveDir, validTime.strftime("%H%M.png")), transparent=True, bbox_inches=extent) 
+            gisFig.savefig(path.join(gisSaveDir, imageName), transparent=True, bbox_inches="tight", pad_inches=0) 
     fig = plt.figure()
     ax = plt.axes(projection=ccrs.LambertConformal())
     ax.set_extent([-130, -60, 20, 50], crs=ccrs.PlateCarree())
@@ -169,13 +186,13 @@ if __name__ == "__main__":
     addStationPlot(ax, validTime)
     plot_bulletin(ax, df)
 
-    ax.add_feature(cfeat.STATES.with_scale("50m"), linewidth=0.5)
-    ax.add_feature(cfeat.COASTLINE.with_scale("50m"), linewidth=0.5)
+    ax.add_feature(statesFeature, linewidth=0.5)
+    ax.add_feature(coastlineFeature, linewidth=0.5)
     Path(staticSaveDir).mkdir(parents=True, exist_ok=True)
     if hasHelpers:
-        HDWX_helpers.writeJson(basePath, 1201, validTime.replace(minute=0), validTime.strftime("%H%M.png"), validTime, ["0,0", "0,0"], 300)
+        HDWX_helpers.writeJson(basePath, 1201, validTime.replace(minute=0), imageName, validTime, ["0,0", "0,0"], 300)
         HDWX_helpers.dressImage(fig, ax, f"WPC Surface Analysis", validTime)
-        HDWX_helpers.saveImage(fig, path.join(staticSaveDir, validTime.strftime("%H%M.png")))
+        HDWX_helpers.saveImage(fig, path.join(staticSaveDir, imageName))
     else:
-        fig.savefig(path.join(staticSaveDir, validTime.strftime("%H%M.png")))
+        fig.savefig(path.join(staticSaveDir, imageName))
 